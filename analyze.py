@@ -1,68 +1,177 @@
+import asyncio
 import sqlite3
 import ollama
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
 from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
+
+# FFTで高速化されたopenTSNEがあれば優先して使い、なければscikit-learnのt-SNEを使う
+try:
+    from openTSNE import TSNE as OpenTSNE
+except ImportError:
+    OpenTSNE = None
+    from sklearn.manifold import TSNE
+
+# RAPIDS cuML (CUDA) が使える環境ではt-SNEとK-MeansをGPUで実行する
+try:
+    import cupy as cp
+    from cuml.manifold import TSNE as GpuTSNE
+    from cuml.cluster import KMeans as GpuKMeans
+except ImportError:
+    cp = None
 
 # Windowsで日本語フォントを表示するための設定
 plt.rcParams['font.family'] = 'Meiryo' 
 
+# Embeddingの同時リクエスト数
+# Ollama側も並列処理させる場合は環境変数 OLLAMA_NUM_PARALLEL を設定してからサーバーを起動してください
+# 例: OLLAMA_NUM_PARALLEL=8 ollama serve
+EMBED_CONCURRENCY = 8
+
+# DBにキャッシュするEmbeddingの型（float16で保存してサイズを半分にする）
+EMBEDDING_DTYPE = np.float16
+
+# mistralのEmbeddingの次元数（キャッシュの形式チェックに使う）
+EMBEDDING_DIM = 4096
+
+# ラベルから改行を取り除くための変換表
+_NL_TRANS = str.maketrans('', '', '\n\r')
+
+# ラベル同士がこの距離（プロット範囲に対する割合）より近い場合は後の方を省略する
+LABEL_RADIUS_RATIO = 0.03
+
+DB_NAME = "posted_news.db"
+
 def get_data():
-    """データベースからニュースの要約を取得"""
-    conn = sqlite3.connect("posted_news.db")
-    df = pd.read_sql("SELECT summary FROM posted_articles WHERE summary IS NOT NULL", conn)
+    """データベースからニュースのURL・要約・保存済みEmbeddingを取得"""
+    conn = sqlite3.connect(DB_NAME)
+    # Embeddingキャッシュ用カラムがない場合のマイグレーション
+    cols = {row[1] for row in conn.execute("PRAGMA table_info(posted_articles)")}
+    if 'embedding' not in cols:
+        conn.execute("ALTER TABLE posted_articles ADD COLUMN embedding BLOB")
+    rows = conn.execute("SELECT url, summary, embedding FROM posted_articles WHERE summary IS NOT NULL").fetchall()
+    conn.close()
+    return rows
+
+def save_embeddings(pairs):
+    """(url, ベクトル) のリストを1トランザクションでDBに保存"""
+    conn = sqlite3.connect(DB_NAME)
+    with conn:
+        conn.executemany("UPDATE posted_articles SET embedding = ? WHERE url = ?",
+                         [(vec.astype(EMBEDDING_DTYPE).tobytes(), url) for url, vec in pairs])
     conn.close()
-    return df
+
+async def _embed_all(texts):
+    """Semaphoreで同時数を制限しつつ、AsyncClientで並列にEmbeddingを取得"""
+    sem = asyncio.Semaphore(EMBED_CONCURRENCY)
+    client = ollama.AsyncClient()
+    done = 0
+
+    async def one(text):
+        nonlocal done
+        async with sem:
+            # 改行などを除去してMistralでEmbeddingを取得
+            response = await client.embeddings(model='mistral', prompt=text.replace('\n', ' '))
+        done += 1
+        if done % 5 == 0:
+            print(f"   ... {done} 件完了")
+        return response['embedding']
+
+    # gatherは入力順で結果を返すので、textsとの対応は保たれる
+    return await asyncio.gather(*(one(t) for t in texts))
 
 def get_embeddings(texts):
     """Ollamaを使ってテキストをベクトル化"""
-    vectors = []
     print(f"🔄 {len(texts)} 件のデータをベクトル化中...")
-    
-    for i, text in enumerate(texts):
-        # 改行などを除去
-        clean_text = text.replace('\n', ' ')
-        
-        # Mistralを使ってEmbeddingを取得
-        response = ollama.embeddings(model='mistral', prompt=clean_text)
-        vectors.append(response['embedding'])
-        
-        if (i + 1) % 5 == 0:
-            print(f"   ... {i + 1} 件完了")
-            
-    return np.array(vectors)
+    vectors = asyncio.run(_embed_all(texts))
+    return np.asarray(vectors, dtype=np.float32)
+
+def load_embeddings(rows):
+    """キャッシュ済みのEmbeddingは再利用し、未計算の分だけOllamaでベクトル化してDBに保存"""
+    vectors = [None] * len(rows)
+    missing = []
+    blob_size = EMBEDDING_DIM * np.dtype(EMBEDDING_DTYPE).itemsize
+    for i, (url, summary, blob) in enumerate(rows):
+        # 形式の違う古いキャッシュ（float32など）はサイズが合わないので計算し直す
+        if blob is not None and len(blob) == blob_size:
+            vectors[i] = np.frombuffer(blob, dtype=EMBEDDING_DTYPE)
+        else:
+            missing.append(i)
+
+    print(f"💾 キャッシュ済み: {len(rows) - len(missing)} 件")
+    if missing:
+        new_vectors = get_embeddings([rows[i][1] for i in missing])
+        # 長さを1に正規化してから保存する（float16の精度を大きさではなく向きに使うため）
+        # ユークリッド距離がコサイン類似度と同じ順序になる
+        new_vectors /= np.linalg.norm(new_vectors, axis=1, keepdims=True) + 1e-12
+        for i, vec in zip(missing, new_vectors):
+            vectors[i] = vec
+        save_embeddings([(rows[i][0], vec) for i, vec in zip(missing, new_vectors)])
+
+    # t-SNEはfloat32/64しか受け付けないのでfloat32に揃える
+    # float16の丸め誤差や正規化前に保存されたキャッシュがあっても長さ1に揃え直す
+    out = np.vstack(vectors).astype(np.float32)
+    out /= np.linalg.norm(out, axis=1, keepdims=True) + 1e-12
+    return out
+
+def run_tsne(vectors, perp):
+    """t-SNEで2次元座標に変換"""
+    if cp is not None:
+        tsne = GpuTSNE(n_components=2, perplexity=perp, random_state=42)
+        return cp.asnumpy(tsne.fit_transform(cp.asarray(vectors)))
+
+    if OpenTSNE is not None:
+        tsne = OpenTSNE(n_components=2, perplexity=perp, initialization='pca',
+                        negative_gradient_method='fft', n_jobs=-1, random_state=42)
+        return np.asarray(tsne.fit(vectors))
+
+    tsne = TSNE(n_components=2, random_state=42, perplexity=perp, init='pca', learning_rate='auto', n_jobs=-1)
+    return tsne.fit_transform(vectors)
+
+def run_kmeans(points, num_clusters):
+    """K-Meansでクラスタ番号を付ける"""
+    if cp is not None:
+        kmeans = GpuKMeans(n_clusters=num_clusters, random_state=42)
+        return cp.asnumpy(kmeans.fit_predict(cp.asarray(points)))
+
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, random_state=42, n_init='auto', batch_size=256)
+    return kmeans.fit_predict(points)
 
 def main():
     # 1. データのロード
-    df = get_data()
+    rows = get_data()
+    summaries = [row[1] for row in rows]
     
-    if len(df) < 5:
+    if len(summaries) < 5:
         print("⚠️ データが少なすぎます。Botを動かしてニュースが5件以上溜まってから実行してください。")
         return
 
     # 2. ベクトル化 (Embedding)
     # テキストの意味を数値の配列に変換します
-    vectors = get_embeddings(df['summary'].tolist())
+    # (キャッシュ済みのものも含め、長さ1に正規化されたベクトルが返ります)
+    vectors = load_embeddings(rows)
 
     # 3. 次元圧縮 (多次元 -> 2次元)
     # PCAで大まかに圧縮してから、t-SNEで分布を調整するのが一般的です
     print("📉 2次元に圧縮中...")
     
+    # PCAで50次元まで落としておくと、t-SNEの近傍探索が大幅に軽くなります
+    n_pca = min(50, vectors.shape[0] - 1, vectors.shape[1])
+    reduced = PCA(n_components=n_pca, random_state=42).fit_transform(vectors).astype(np.float32)
+
     # データ数が少ない場合はperplexityを下げる必要があります
-    perp = min(30, len(df) - 1)
+    perp = min(30, len(summaries) - 1)
     
     # t-SNEを使って2次元座標に変換
-    tsne = TSNE(n_components=2, random_state=42, perplexity=perp, init='pca', learning_rate='auto')
-    coords = tsne.fit_transform(vectors)
+    coords = run_tsne(reduced, perp)
 
     # 4. クラスタリング (K-Means)
     # 近い位置にある点を色分けします（ここでは3グループに分類）
+    # 元の高次元ベクトルではなく、PCAで圧縮したベクトル上でクラスタリングすると軽量
     num_clusters = 3 
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init='auto')
-    clusters = kmeans.fit_predict(vectors)
+    clusters = run_kmeans(reduced, num_clusters)
 
     # 5. プロット
     print("🎨 描画中...")
@@ -72,10 +181,18 @@ def main():
     scatter = plt.scatter(coords[:, 0], coords[:, 1], c=clusters, cmap='viridis', alpha=0.7)
     
     # 各点に要約の冒頭を表示（マウスオーバー等はできないので文字で出力）
-    for i, txt in enumerate(df['summary']):
-        # 文字が長すぎると見づらいので先頭15文字だけ
-        label = txt[:15].replace('\n', '') + "..."
+    # 文字が長すぎると見づらいので先頭15文字だけ
+    labels = [txt[:15].translate(_NL_TRANS) + "..." for txt in summaries]
+
+    # すでにラベルを付けた点の近くにある点はラベルを省略して重なりを防ぐ
+    radius = LABEL_RADIUS_RATIO * np.ptp(coords, axis=0).max()
+    tree = cKDTree(coords)
+    covered = np.zeros(len(coords), dtype=bool)
+    for i, label in enumerate(labels):
+        if covered[i]:
+            continue
         plt.annotate(label, (coords[i, 0], coords[i, 1]), fontsize=8, alpha=0.8)
+        covered[tree.query_ball_point(coords[i], radius)] = True
 
     plt.title("ニュース記事のトピック分布 (Semantic Map)")
     plt.xlabel("Dimension 1")
@@ -1,4 +1,5 @@
 import os
+import re
 import asyncio
 import sqlite3
 import datetime
@@ -6,6 +7,7 @@ import feedparser
 import discord
 from discord.ext import tasks
 from dotenv import load_dotenv
+import ollama
 import aiohttp
 
 # --- 設定 ---
@@ -17,9 +19,17 @@ GLOBAL_CHANNEL_ID = 1400070228666486837
 # ニュース取得間隔（分）
 WAIT_TIME_MINUTES = 30 
 
+# LLMへの同時リクエスト数（待機ではなくこの上限で負荷を調整する）
+# Ollama側で並列処理させるには環境変数 OLLAMA_NUM_PARALLEL を同じ値にしてサーバーを起動してください
+# 例: OLLAMA_NUM_PARALLEL=4 ollama serve
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "4"))
+
 # User-Agent（ブラウザのふりをするための名札）
 RSS_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
 
+# HTMLタグ除去用の正規表現（記事ごとにコンパイルしないよう事前に用意）
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
 # 厳選した安定RSSリスト
 NEWS_SOURCES = {
     "JP": { # NHK World (English) - 日本の公式英語ニュース
@@ -63,8 +73,15 @@ NEWS_SOURCES = {
 # --- データベース管理 ---
 class DatabaseManager:
     def __init__(self, db_name="posted_news.db"):
-        self.conn = sqlite3.connect(db_name)
+        # 自動トランザクションを無効にし、まとめて書き込む箇所だけ明示的にBEGIN/COMMITする
+        self.conn = sqlite3.connect(db_name, isolation_level=None)
         self.cursor = self.conn.cursor()
+        # 書き込み性能向上のための設定（WAL、同期の緩和、64MBキャッシュ、256MBメモリマップ）
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self.cursor.execute("PRAGMA temp_store=MEMORY")
+        self.cursor.execute("PRAGMA cache_size=-65536")
+        self.cursor.execute("PRAGMA mmap_size=268435456")
         self.create_table()
 
     def create_table(self):
@@ -73,26 +90,37 @@ class DatabaseManager:
             CREATE TABLE IF NOT EXISTS posted_articles (
                 url TEXT PRIMARY KEY,
                 summary TEXT,
-                posted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                posted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                embedding BLOB
             )
         ''')
-        # 既存のテーブルにsummaryがない場合のマイグレーション（念のため）
-        try:
+        # 既存のテーブルに足りないカラムがある場合のマイグレーション（ある場合は読み取りのみ）
+        cols = {row[1] for row in self.cursor.execute("PRAGMA table_info(posted_articles)")}
+        if 'summary' not in cols:
             self.cursor.execute("ALTER TABLE posted_articles ADD COLUMN summary TEXT")
-        except sqlite3.OperationalError:
-            pass # すでにカラムがある場合は何もしない
-        self.conn.commit()
+        if 'embedding' not in cols:
+            self.cursor.execute("ALTER TABLE posted_articles ADD COLUMN embedding BLOB")
 
-    def is_posted(self, url):
-        self.cursor.execute('SELECT 1 FROM posted_articles WHERE url = ?', (url,))
-        return self.cursor.fetchone() is not None
+    def filter_new(self, urls):
+        """urlsのうち未投稿のものだけを順序を保って返す（1クエリで判定）"""
+        if not urls:
+            return []
+        placeholders = ','.join('?' * len(urls))
+        self.cursor.execute(f'SELECT url FROM posted_articles WHERE url IN ({placeholders})', urls)
+        seen = {row[0] for row in self.cursor.fetchall()}
+        return [u for u in urls if u not in seen]
 
-    def add_article(self, url, summary):
+    def add_articles(self, rows):
+        """(url, summary) のリストを1トランザクションでまとめて保存"""
+        if not rows:
+            return
+        self.cursor.execute("BEGIN")
         try:
-            self.cursor.execute('INSERT INTO posted_articles (url, summary) VALUES (?, ?)', (url, summary))
-            self.conn.commit()
-        except sqlite3.IntegrityError:
-            pass 
+            self.cursor.executemany('INSERT OR IGNORE INTO posted_articles (url, summary) VALUES (?, ?)', rows)
+        except Exception:
+            self.cursor.execute("ROLLBACK")
+            raise
+        self.cursor.execute("COMMIT")
     
     def close(self):
         self.conn.close()
@@ -102,14 +130,47 @@ class NewsBot(discord.Client):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.db = DatabaseManager()
-        self.llm_api_url = "http://localhost:11434/api/generate"
+        self._ollama = None
+        self._llm_sem = None
+        self._http = None
+        # 送信先チャンネル（on_readyで解決する）
+        self._channels = {}
+        self._global_channel = None
 
     async def setup_hook(self):
+        # Ollamaクライアントはイベントループ上で作成し、Botの生存期間中すべてのLLM呼び出しで使い回す
+        self._ollama = ollama.AsyncClient(host="http://localhost:11434", timeout=120)
+        self._llm_sem = asyncio.Semaphore(LLM_CONCURRENCY)
+        # RSS取得用のHTTPセッションも同様に使い回す
+        self._http = aiohttp.ClientSession(
+            headers={"User-Agent": RSS_AGENT},
+            timeout=aiohttp.ClientTimeout(total=60)
+        )
         self.news_loop.start()
 
+    async def close(self):
+        if self._http:
+            await self._http.close()
+        await super().close()
+
     async def on_ready(self):
         print(f'✅ Logged in as {self.user}')
-        print(f'📋 監視対象: {list(NEWS_SOURCES.keys())}')
+
+        # 送信先チャンネルを起動時に一度だけ解決しておく
+        self._channels = {}
+        for country, config in NEWS_SOURCES.items():
+            channel_id = config.get("channel_id")
+            channel = self.get_channel(channel_id) if channel_id else None
+            if channel:
+                self._channels[country] = channel
+            else:
+                print(f"⚠️ チャンネルが見つかりません: {country} (ID: {channel_id})")
+
+        self._global_channel = self.get_channel(GLOBAL_CHANNEL_ID)
+        if not self._global_channel:
+            print(f"⚠️ グローバルチャンネルが見つかりません (ID: {GLOBAL_CHANNEL_ID})")
+
+        print(f'📋 監視対象: {list(self._channels.keys())}')
 
     async def query_llm(self, text, mode="summary"):
         """
@@ -126,47 +187,51 @@ class NewsBot(discord.Client):
         elif mode == "title":
             system_instruction = "Translate to English and create a short, catchy headline (under 10 words) for this news:\n\n"
 
-        payload = {
-            "model": "mistral",
-            "prompt": f"{system_instruction}{text}",
-            "stream": False
-        }
-
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(self.llm_api_url, json=payload) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        return data.get("response", "").strip()
-                    return f"Error: {response.status}"
+            async with self._llm_sem:
+                response = await self._ollama.generate(model="mistral", prompt=f"{system_instruction}{text}", stream=False)
+            return response["response"].strip()
+        except ollama.ResponseError as e:
+            return f"Error: {e.status_code}"
         except Exception as e:
             return f"LLM Error: {e}"
 
-    def get_feed(self, url):
+    async def get_feed(self, url):
         """User-Agentを指定してRSSを取得するラッパー"""
-        return feedparser.parse(url, agent=RSS_AGENT)
+        # 通信はaiohttpで非同期に行い、CPU処理のXMLパースだけを別スレッドで実行
+        async with self._http.get(url) as response:
+            # 403や5xxのエラーページをフィードとして解析しないよう、ここで例外にする（ソースごとに捕捉される）
+            response.raise_for_status()
+            body = await response.read()
+            # Content-Typeの文字コードなどをfeedparserに渡すためヘッダーも一緒に渡す
+            # （feedparserは小文字のキーで参照するので小文字に揃える）
+            headers = {key.lower(): value for key, value in response.headers.items()}
+        return await asyncio.to_thread(feedparser.parse, body, response_headers=headers)
 
     @tasks.loop(minutes=WAIT_TIME_MINUTES)
     async def news_loop(self):
         print(f"🔄 RSS確認開始: {datetime.datetime.now()}")
-        
-        for country, config in NEWS_SOURCES.items():
-            await self.process_rss(country, config)
+
+        # 各ソースは独立しているので同時に処理する
+        # DB操作はすべて同期呼び出しでawaitを挟まないため、同一スレッド上で直列に実行される
+        # 1つのソースで想定外の例外が起きてもループ全体が止まらないようにし、内容はログに残す
+        results = await asyncio.gather(*(self.process_rss(country, config) for country, config in NEWS_SOURCES.items()),
+                                       return_exceptions=True)
+        for country, result in zip(NEWS_SOURCES, results):
+            if isinstance(result, BaseException):
+                print(f"❌ エラー ({country}): {result}")
 
     async def process_rss(self, country, config):
+        # 送信済みの記事はここに溜めて最後にまとめてDBへ保存
+        posted = []
         # チャンネルIDが設定されていない、または無効な場合はスキップ
         try:
-            channel_id = config.get("channel_id")
-            if not channel_id:
-                return
-            
-            channel = self.get_channel(channel_id)
+            channel = self._channels.get(country)
             if not channel:
-                # print(f"⚠️ チャンネルが見つかりません: {country} (ID: {channel_id})")
                 return
 
             # RSS取得
-            feed = await asyncio.to_thread(self.get_feed, config["rss_url"])
+            feed = await self.get_feed(config["rss_url"])
             
             # 記事が取れなかった場合
             if not feed.entries:
@@ -175,25 +240,30 @@ class NewsBot(discord.Client):
 
             print(f"📡 {country}: {len(feed.entries)}件の記事を取得")
 
-            # 最新3件まで処理
-            for entry in feed.entries[:3]:
+            # 最新3件まで処理（投稿済みかどうかはまとめて判定）
+            entries = feed.entries[:3]
+            new_urls = set(self.db.filter_new([entry.link for entry in entries]))
+            for entry in entries:
                 url = entry.link
-                if self.db.is_posted(url):
+                if url not in new_urls:
                     continue
+                # 同じフィード内で同じリンクが重複していても1回だけ投稿する
+                new_urls.discard(url)
 
                 # テキスト抽出 (Description or Summary)
                 raw_text =  entry.get('description') or entry.get('summary') or entry.title
                 
                 # HTMLタグの簡易除去（Descriptionに画像タグなどが含まれる場合があるため）
                 if raw_text and "<" in raw_text:
-                    import re
-                    raw_text = re.sub(r'<[^>]+>', '', raw_text)
+                    raw_text = _HTML_TAG_RE.sub('', raw_text)
 
                 print(f"🆕 記事発見 ({country}): {entry.title}")
 
-                # LLM処理
-                key_points = await self.query_llm(raw_text, mode="summary")
-                title_en = await self.query_llm(entry.title, mode="title")
+                # LLM処理（要約とタイトルは独立しているので同時に投げる）
+                key_points, title_en = await asyncio.gather(
+                    self.query_llm(raw_text, mode="summary"),
+                    self.query_llm(entry.title, mode="title")
+                )
 
                 # フォーマット: タイトル + Key Points + URL
                 message = f"**{title_en}**\n\n{key_points}\n\n{url}"
@@ -202,18 +272,20 @@ class NewsBot(discord.Client):
                 await channel.send(message)
                 
                 # グローバルチャンネルへ送信
-                global_ch = self.get_channel(GLOBAL_CHANNEL_ID)
-                if global_ch:
-                    await global_ch.send(f"[{country}] {message}")
+                if self._global_channel:
+                    await self._global_channel.send(f"[{country}] {message}")
 
-                # データベースに保存
-                self.db.add_article(url, key_points)
-                
-                # レート制限考慮（少し待機）
-                await asyncio.sleep(3)
+                # データベース保存用に記録
+                posted.append((url, key_points))
 
         except Exception as e:
             print(f"❌ エラー ({country}): {e}")
+        finally:
+            # 途中でエラーになっても送信済みの分は保存する（二重投稿防止）
+            try:
+                self.db.add_articles(posted)
+            except Exception as e:
+                print(f"❌ DB保存エラー ({country}): {e}")
 
     @news_loop.before_loop
     async def before_news_loop(self):